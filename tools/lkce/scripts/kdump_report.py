@@ -24,35 +24,73 @@
 Program that runs inside kdump kernel
 Program to run the crash or corelens utility inside the kdump kernel
 """
-import glob
+import heapq
 import time
 import os
-import platform
-import re
 import shutil
+import signal
 import subprocess  # nosec
 import sys
-from typing import Optional, List
+from typing import Optional, List, Sequence
 
 MIN_SYSTEM_MEMORY_KB = 768 << 10
+KERNEL_RELEASE = os.uname().release
+# str.translate() table that deletes all whitespace
+DELETE_WHITESPACE = str.maketrans("", "", " \t\r\n\v\f")
 
 
 def read_corelens_args(filename: str) -> Optional[List[str]]:
     """Read command line arguments file and return the args as a list"""
     try:
         with open(filename, 'r') as f:
-            args = [
-                w.strip()
-                for l in f
-                for w in l.split()
-                if not l.startswith('#')
-            ]
-            return args
+            data = f.read()
+        args = [
+            w
+            for l in data.splitlines()
+            if not l.lstrip().startswith('#')
+            for w in l.split()
+        ]
+        return args
     except OSError as e:
         print(f"kdump_report: Unable to operate on file: {filename}: {e}")
         return None
 
 
+def spawn_report_cmd(args: Sequence[str], output_file: str) -> int:
+    """Run args with stdout and stderr sent to output_file; return exit status.
+
+    Use posix_spawn() where available so that the child is started without
+    duplicating our page tables first; memory is scarce in the kdump kernel.
+    """
+    output_fd = os.open(output_file,
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                        0o644)
+    try:
+        if not hasattr(os, "posix_spawn"):  # python < 3.8
+            r = subprocess.run(args, close_fds=True, stdout=output_fd,
+                               stderr=output_fd, stdin=subprocess.DEVNULL,
+                               shell=False, check=False)  # nosec
+            return r.returncode
+
+        file_actions = [
+            (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+            (os.POSIX_SPAWN_DUP2, output_fd, 1),
+            (os.POSIX_SPAWN_DUP2, output_fd, 2),
+        ]
+        # like subprocess' restore_signals, don't pass on the SIG_IGN that
+        # Python installs for these
+        pid = os.posix_spawn(args[0], list(args), os.environ,
+                             file_actions=file_actions,
+                             setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    finally:
+        os.close(output_fd)
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 1
+
+
 def get_system_memory() -> int:
     """Return the amount of total memory in KB"""
     try:
@@ -71,11 +109,22 @@ def get_system_memory() -> int:
 class KdumpReport:
     """Class to include all kdump report related functionality"""
     # pylint: disable=too-many-instance-attributes
+
+    # config file keys and the attributes they set
+    CONFIG_KEYS = {
+        "report_cmd": "report_cmd",
+        "vmlinux_path": "vmlinux_path",
+        "crash_cmds_file": "crash_cmds_file",
+        "corelens_args_file": "corelens_args_file",
+        "max_out_files": "max_out_files",
+        "lkce_outdir": "kdump_report_out",
+    }
+
     def __init__(self) -> None:
         """Constructor for KdumpReport class"""
         self.vmlinux = ""
         self.vmcore = "/proc/vmcore"
-        self.kdump_kernel_ver = platform.uname().release
+        self.kdump_kernel_ver = KERNEL_RELEASE
         self.report_cmd = "corelens"
 
         self.kdump_report_home = "/etc/oled/lkce"
@@ -94,56 +143,55 @@ class KdumpReport:
         self.crash_cmds_file = self.kdump_report_crash_cmds_file
 
         self.corelens_args_file = self.kdump_report_corelens_args_file
-        self.max_out_files = "50"
+        self.max_out_files = 50
         self.corelens_args = ["-a"]
 
-        self.read_config(self.kdump_report_config_file)
+        # set when a report is actually run
+        self.kdump_report_out_file = ""
 
-        self.kdump_report_out_file = self.kdump_report_out + \
-            f"/{self.report_cmd}_" + time.strftime("%Y%m%d-%H%M%S") + ".out"
+        self.read_config(self.kdump_report_config_file)
     # def __init__
 
     def read_config(self, filename: str) -> int:
         """Read config file and update the class variables"""
-        if not os.path.exists(filename):
-            sys.exit(1)
-
         try:
-            file = open(filename, "r")
+            with open(filename, "r") as file:
+                data = file.read()
+        except FileNotFoundError:
+            sys.exit(1)
         except OSError:
             print(f"kdump_report: Unable to operate on file: {filename}")
             return 1
 
-        for line in file.readlines():
-            if re.search("^#", line):  # ignore lines starting with '#'
+        for line in data.splitlines():
+            stripped = line.strip()
+            # ignore empty lines and lines starting with '#'
+            if not stripped or stripped[0] == "#":
                 continue
 
-            # trim space/tab/newline from the line
-            line = re.sub(r"\s+", "", line)
-
-            entry = re.split("=", line)
-
-            if "report_cmd" in entry[0] and entry[1]:
-                self.report_cmd = entry[1]
-                if self.report_cmd not in ("crash", "corelens"):
-                    print("kdump_report: Invalid report command: %s" %
-                          {self.report_cmd})
-                    return 1
-
-            elif "vmlinux_path" in entry[0] and entry[1]:
-                self.vmlinux_path = entry[1]
-
-            elif "crash_cmds_file" in entry[0] and entry[1]:
-                self.crash_cmds_file = entry[1]
+            # trim space/tab from the line
+            line = stripped.translate(DELETE_WHITESPACE)
+            key, _, value = line.partition("=")
+            attr = self.CONFIG_KEYS.get(key)
+            if attr is None or not value:
+                continue
 
-            elif "corelens_args_file" in entry[0] and entry[1]:
-                self.corelens_args_file = entry[1]
+            if attr == "report_cmd" and value not in ("crash", "corelens"):
+                print(f"kdump_report: Invalid report command: {value}")
+                return 1
 
-            elif "max_out_files" in entry[0] and entry[1]:
-                self.max_out_files = entry[1]
+            if attr == "max_out_files":
+                try:
+                    max_out_files = int(value)
+                    if max_out_files < 0:
+                        raise ValueError(value)
+                    setattr(self, attr, max_out_files)
+                except ValueError:
+                    # keep the default
+                    print("kdump_report: Invalid max_out_files value:", value)
+                continue
 
-            elif "lkce_outdir" in entry[0] and entry[1]:
-                self.kdump_report_out = entry[1]
+            setattr(self, attr, value)
 
         return 0
     # def read_config
@@ -153,6 +201,10 @@ class KdumpReport:
 
         Report error if not found
         """
+        if self.vmlinux:
+            # already located by an earlier call
+            return 0
+
         vmlinux_1 = self.vmlinux_path
         vmlinux_2 = "/usr/lib/debug/lib/modules/" + \
                     self.kdump_kernel_ver + "/vmlinux"
@@ -163,10 +215,10 @@ class KdumpReport:
             self.vmlinux = vmlinux_2
         else:
             if verbose:
-                print("kdump_report: vmlinux not found in following",
-                      "locations:")
-                print(f"kdump_report: {vmlinux_1}")
-                print(f"kdump_report: {vmlinux_2}")
+                sys.stdout.write("kdump_report: vmlinux not found in "
+                                 "following locations:\n"
+                                 f"kdump_report: {vmlinux_1}\n"
+                                 f"kdump_report: {vmlinux_2}\n")
             return 1
         if verbose:
             print(f"kdump_report: vmlinux found at {self.vmlinux}")
@@ -195,19 +247,15 @@ class KdumpReport:
                 return 0
 
         os.makedirs(self.kdump_report_out, exist_ok=True)
+        self.kdump_report_out_file = self.kdump_report_out + \
+            f"/{self.report_cmd}_" + time.strftime("%Y%m%d-%H%M%S") + ".out"
 
         args = (crash_path, self.vmlinux, self.vmcore, "-i",
                 self.crash_cmds_file)
         print(f"kdump_report: Executing '{' '.join(args)}'; output file "
               f"'{self.kdump_report_out_file}'")
 
-        ret = 0
-        with open(self.kdump_report_out_file, "w") as output_fd:
-            r = subprocess.run(args, close_fds=True, stdout=output_fd,
-                               stderr=output_fd, stdin=subprocess.DEVNULL,
-                               shell=False, check=True)  # nosec
-            ret = r.returncode
-        return ret
+        return spawn_report_cmd(args, self.kdump_report_out_file)
     # def run_crash
 
     def run_corelens(self) -> int:
@@ -227,6 +275,8 @@ class KdumpReport:
                 return 0
 
         os.makedirs(self.kdump_report_out, exist_ok=True)
+        self.kdump_report_out_file = self.kdump_report_out + \
+            f"/{self.report_cmd}_" + time.strftime("%Y%m%d-%H%M%S") + ".out"
 
         args = [corelens_path, self.vmcore]
         corelens_args = read_corelens_args(self.corelens_args_file)
@@ -237,13 +287,7 @@ class KdumpReport:
         print(f"kdump_report: Executing '{' '.join(args)}'; output file "
               f"'{self.kdump_report_out_file}'")
 
-        ret = 0
-        with open(self.kdump_report_out_file, "w") as output_fd:
-            r = subprocess.run(args, close_fds=True, stdout=output_fd,
-                               stderr=output_fd, stdin=subprocess.DEVNULL,
-                               shell=False, check=True)  # nosec
-            ret = r.returncode
-        return ret
+        return spawn_report_cmd(args, self.kdump_report_out_file)
     # def run_corelens
 
     def run_report(self) -> int:
@@ -255,21 +299,44 @@ class KdumpReport:
 
     def clean_up(self) -> None:
         """Clean up old corelens reports to save space"""
-        max_files = int(self.max_out_files)
+        max_files = self.max_out_files
         report_files = []
-        for p in ("crash*.out", "corelens*.out"):
-            report_files.extend(glob.glob(f"{self.kdump_report_out}/{p}"))
+        try:
+            with os.scandir(self.kdump_report_out) as it:
+                for e in it:
+                    if e.name.startswith(("crash", "corelens")) and \
+                            e.name.endswith(".out") and e.is_file():
+                        report_files.append((e.stat().st_ctime_ns, e.name))
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print(f"kdump_report: Unable to scan {self.kdump_report_out}: {e}")
+            return
 
         if len(report_files) > max_files:
             print(f"kdump_report: found more than {max_files}[max_out_files] "
                   "out files. Deleting older ones")
 
-            report_files.sort(key=lambda x: os.path.getctime(x), reverse=True)
-            for f in report_files[max_files:]:
-                try:
-                    os.remove(f)
-                except OSError as e:
-                    print(f"kdump_report: Error removing file {f}: {e}")
+            # only select the oldest files beyond max_files
+            victims = heapq.nsmallest(len(report_files) - max_files,
+                                      report_files)
+            try:
+                dir_fd = os.open(self.kdump_report_out,
+                                 os.O_RDONLY | os.O_DIRECTORY)
+            except OSError as e:
+                print(f"kdump_report: Unable to open {self.kdump_report_out}:",
+                      e)
+                return
+
+            try:
+                for _, f in victims:
+                    try:
+                        os.unlink(f, dir_fd=dir_fd)
+                    except OSError as e:
+                        print("kdump_report: Error removing file",
+                              f"{self.kdump_report_out}/{f}: {e}")
+            finally:
+                os.close(dir_fd)
     # def clean_up
 # class KDUMP_REPORT
 
@@ -279,8 +346,14 @@ def main() -> int:
     kdump_report = KdumpReport()
 
     print("kdump_report: kdump_report is enabled to run")
-    kdump_report.run_report()
-    kdump_report.clean_up()
+    ret = kdump_report.run_report()
+    # kdump_report_out_file is only set once crash/corelens has been started;
+    # keep the older reports if it ran and failed
+    if ret and kdump_report.kdump_report_out_file:
+        print(f"kdump_report: {kdump_report.report_cmd} exited with "
+              f"status {ret}")
+    else:
+        kdump_report.clean_up()
     sys.exit(0)
 # def main
 
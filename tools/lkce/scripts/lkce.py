@@ -26,15 +26,21 @@ Program for user-interaction
 
 import errno
 import fcntl
-import glob
+import heapq
 import os
-import platform
-import re
 import shutil
+import signal
 import stat
+import string
 import subprocess  # nosec
 import sys
-from typing import Mapping, Optional, List, Tuple, Union, Sequence
+from typing import (Callable, Dict, Mapping, Optional, List, Tuple, Union,
+                    Sequence)
+
+KERNEL_RELEASE = os.uname().release
+# str.translate() table that deletes all whitespace
+DELETE_WHITESPACE = str.maketrans("", "", " \t\r\n\v\f")
+DEFAULT_VMLINUX_PATH = f"/usr/lib/debug/lib/modules/{KERNEL_RELEASE}/vmlinux"
 
 
 def update_key_values_file(
@@ -50,68 +56,194 @@ def update_key_values_file(
     a separator, in which case the value is assumed to be empty.
     """
     with open(path) as fdesc:
-        data = fdesc.read().splitlines()
-
-    with open(path, "w") as fdesc:
-        for line in data:
-            key, *_ = line.split("=", maxsplit=1)
-            key = key.strip()
+        old_content = fdesc.read()
 
-            if key in key_values:
-                new_value = key_values[key]
-                del key_values[key]
-
-                # If new_value is not None, update the value; otherwise remove
-                # it (i.e. don't write key-new_value back to the file).
-                if new_value is not None:
-                    fdesc.write(f"{key}{sep}{new_value}\n")
-            else:
-                # line doesn't match lines to update; write it back as is
-                fdesc.write(f"{line}\n")
+    out = []
+    seen = set()
+    for line in old_content.splitlines():
+        key = line.partition(sep)[0].strip()
 
-        # write out any params that do not have existing entries.
-        for key in key_values:
+        if key in key_values and key not in seen:
             new_value = key_values[key]
-            if new_value:
-                fdesc.write(f"\n{key}{sep}{new_value}\n")
+            seen.add(key)
+
+            # If new_value is not None, update the value; otherwise remove
+            # it (i.e. don't write key-new_value back to the file).
+            if new_value is not None:
+                out.append(f"{key}{sep}{new_value}\n")
+        else:
+            # line doesn't match lines to update; write it back as is
+            out.append(f"{line}\n")
+
+    # write out any params that do not have existing entries.
+    for key, new_value in key_values.items():
+        if key not in seen and new_value:
+            out.append(f"\n{key}{sep}{new_value}\n")
+
+    content = "".join(out)
+    # every rewritten line ends in a newline, the last line of the file
+    # (e.g. as written by configure_default) might not
+    if content in (old_content, f"{old_content}\n"):
+        return
+
+    # write the new contents next to the file and rename it into place, so
+    # that a failure midway never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fdesc:
+        fdesc.write(content)
+        fdesc.flush()
+        os.fdatasync(fdesc.fileno())
+    shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
 
 
 def read_args_from_file(filename: str) -> Optional[List[str]]:
     """Read command line arguments file and return the args as a list"""
     try:
         with open(filename, 'r') as f:
-            args = [
-                w.strip()
-                for l in f
-                for w in l.split()
-                if not l.startswith('#')
-            ]
+            args: List[str] = []
+            for line in f:
+                if not line.lstrip().startswith('#'):
+                    args.extend(line.split())
             return args
     except OSError as e:
-        print(f"kdump_report: Unable to operate on file: {filename}: {e}")
+        print(f"lkce: Unable to read arguments file {filename}: {e}")
         return None
 
 
+def spawn_cmd(cmd: Sequence[str], stdout_fd: int,
+              cmd_input: Optional[bytes] = None) -> None:
+    """Run cmd with its stdout sent to stdout_fd and wait for it.
+
+    Raise subprocess.CalledProcessError if cmd fails.  When no input needs to
+    be piped to cmd, start it with posix_spawnp() where available instead of
+    going through subprocess' fork/exec.
+    """
+    if cmd_input is not None or not hasattr(os, "posix_spawnp"):
+        subprocess.run(cmd, input=cmd_input, stdout=stdout_fd, check=True,
+                       shell=False)  # nosec
+        return
+
+    # like subprocess' restore_signals, don't pass on the SIG_IGN that
+    # Python installs for these
+    pid = os.posix_spawnp(cmd[0], list(cmd), os.environ,
+                          file_actions=[(os.POSIX_SPAWN_DUP2, stdout_fd, 1)],
+                          setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    _, status = os.waitpid(pid, 0)
+    ret = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    if ret:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+
+def run_report_cmd(cmd: Sequence[str], outfile: Optional[str],
+                   cmd_input: Optional[bytes] = None) -> None:
+    """Run a report command, writing its output to outfile or to stdout"""
+    if outfile:
+        with open(outfile, "wb") as output_fd:
+            spawn_cmd(cmd, output_fd.fileno(), cmd_input)
+    else:
+        # the child writes straight to our stdout fd; flush what we printed
+        # so far so that it stays ahead of the report
+        sys.stdout.flush()
+        spawn_cmd(cmd, sys.stdout.fileno(), cmd_input)
+
+
+def unescape_mount_path(path: str) -> str:
+    """Undo the octal escaping of blanks and backslashes in /proc/mounts"""
+    if "\\" not in path:
+        return path
+    for esc, char in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n"),
+                      ("\\134", "\\")):
+        path = path.replace(esc, char)
+    return path
+
+
+_MOUNTS: Optional[List[Tuple[str, str]]] = None
+_MOUNT_DEVS: Dict[str, Optional[int]] = {}
+
+
+def get_mounts() -> List[Tuple[str, str]]:
+    """Return (device, mountpoint) for each /proc/mounts entry, in order.
+
+    /proc/mounts is only read on the first call; lkce does not mount
+    anything itself, so the result stays valid for the life of the process.
+    """
+    global _MOUNTS  # pylint: disable=global-statement
+    if _MOUNTS is None:
+        mounts: List[Tuple[str, str]] = []
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                tok = line.split()
+                if len(tok) >= 2:
+                    mounts.append((tok[0], unescape_mount_path(tok[1])))
+        _MOUNTS = mounts
+    return _MOUNTS
+
+
+def get_mount_dev_id(mp: str) -> Optional[int]:
+    """Return st_dev of mountpoint mp, or None if it can't be stat()ed.
+
+    Each mount point is stat()ed at most once per process.  The major:minor
+    in /proc/self/mountinfo can't be used instead: on btrfs, stat() returns
+    a per-subvolume anonymous device rather than the superblock's s_dev.
+    """
+    if mp not in _MOUNT_DEVS:
+        try:
+            _MOUNT_DEVS[mp] = os.stat(mp).st_dev
+        except OSError:
+            _MOUNT_DEVS[mp] = None
+    return _MOUNT_DEVS[mp]
+
+
 def get_dev_and_mount(path: str) -> Tuple[Union[str, None], Union[str, None]]:
     """ Return the device path and mountpoint for a file or directory"""
     try:
         st = os.stat(path)
-        dev_id = st.st_dev
-
-        with open("/proc/mounts", "r") as mounts:
-            for line in mounts:
-                tok = line.split()
-                dev = tok[0]
-                mp = tok[1]
-
-                st = os.stat(mp)
-                if st.st_dev == dev_id:
-                    return (dev, mp)
-        return (None, None)
     except FileNotFoundError:
         print(f"error: '{path}' not found.")
         return (None, None)
 
+    try:
+        mounts = get_mounts()
+    except OSError as e:
+        print(f"error: Unable to read /proc/mounts: {e}")
+        return (None, None)
+
+    # Only a mount point on the path's own ancestry can hold it, so other
+    # mounts (which may be unresponsive network mounts or automounts) are
+    # never stat()ed; we also stop at the first match.
+    real_path = os.path.realpath(path)
+    for dev, mp in mounts:
+        if mp != "/" and real_path != mp and \
+                not real_path.startswith(mp + "/"):
+            continue
+        if get_mount_dev_id(mp) == st.st_dev:
+            return (dev, mp)
+    return (None, None)
+
+
+_UUIDS: Optional[Dict[int, str]] = None
+
+
+def get_uuids() -> Dict[int, str]:
+    """Return a dict mapping st_rdev to UUID for /dev/disk/by-uuid entries.
+
+    The directory is only scanned on the first call.
+    """
+    global _UUIDS  # pylint: disable=global-statement
+    if _UUIDS is None:
+        uuids: Dict[int, str] = {}
+        with os.scandir("/dev/disk/by-uuid") as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=True)
+                except OSError as e:
+                    print(f"error: Unable to stat {entry.name}: {e}")
+                    continue
+                uuids.setdefault(st.st_rdev, entry.name)
+        _UUIDS = uuids
+    return _UUIDS
+
 
 def get_dev_uuid(dev: str) -> Union[str, None]:
     """ Return the UUID for a device"""
@@ -123,21 +255,12 @@ def get_dev_uuid(dev: str) -> Union[str, None]:
         return None
 
     try:
-        files = os.listdir("/dev/disk/by-uuid")
+        uuids = get_uuids()
     except OSError as e:
         print(f"error: Unable to list /dev/disk/by-uuid: {e}")
         return None
 
-    try:
-        for f in files:
-            path = f"/dev/disk/by-uuid/{f}"
-            st = os.stat(path, follow_symlinks=True)
-            if st.st_rdev == dev_id:
-                return f
-    except OSError as e:
-        print(f"error: Unable to stat {f}: {e}")
-
-    return None
+    return uuids.get(dev_id)
 
 
 def get_kdump_pre_line(filename: str) -> Union[str, None]:
@@ -147,42 +270,176 @@ def get_kdump_pre_line(filename: str) -> Union[str, None]:
     """
     try:
         with open(filename) as conf_fd:
-            conf_lines = conf_fd.read().splitlines()
-            conf_fd.close()
-        for line in conf_lines:
-            if line.startswith("kdump_pre "):
-                return line
+            for line in conf_fd:
+                if line.startswith("kdump_pre "):
+                    return line.rstrip("\n")
     except OSError:
         pass
 
     return None
 
 
+def is_report_name(name: str) -> bool:
+    """Return True if name looks like a crash or corelens report file"""
+    # the suffix test rejects most other files, so do it first
+    return name.endswith(".out") and name.startswith(("crash", "corelens"))
+
+
+def parse_max_out_files(value: str) -> Optional[int]:
+    """Return max_out_files as a non-negative int, or None if it isn't one"""
+    try:
+        max_out_files = int(value)
+    except ValueError:
+        return None
+    return max_out_files if max_out_files >= 0 else None
+
+
+_PKG_INSTALLED: Dict[str, bool] = {}
+
+# executable shipped by each package we check for
+PKG_EXECUTABLES = {
+    "crash": "crash",
+    "drgn-tools": "corelens",
+}
+
+
+def pkg_installed(pkg: str) -> bool:
+    """Return True if the rpm package pkg is installed.
+
+    If the package's executable is found in PATH, the package is assumed to
+    be installed.  Otherwise the rpm Python bindings are used when available
+    so that the rpm database is queried in-process, or else 'rpm -q' is run.
+    Results are cached for the life of the process.
+    """
+    if pkg not in _PKG_INSTALLED:
+        exe = PKG_EXECUTABLES.get(pkg)
+        if exe and shutil.which(exe):
+            _PKG_INSTALLED[pkg] = True
+            return True
+
+        installed: Optional[bool] = None
+        try:
+            import rpm  # pylint: disable=import-outside-toplevel
+
+            try:
+                ts = rpm.TransactionSet()
+                installed = ts.dbMatch("name", pkg).count() > 0
+            except rpm.error:
+                # rpmdb unusable from here; let 'rpm -q' decide
+                pass
+        except ImportError:
+            pass
+
+        if installed is None:
+            try:
+                r = subprocess.run(("rpm", "-q", pkg), shell=False,  # nosec
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, check=False)
+                installed = r.returncode == 0
+            except OSError:
+                installed = False
+        _PKG_INSTALLED[pkg] = installed
+    return _PKG_INSTALLED[pkg]
+
+
 class Lkce:
     """Class to include user interaction related functionality"""
     # pylint: disable=too-many-instance-attributes
 
+    # config file keys and the attributes they set
+    CONFIG_KEYS = {
+        "report_cmd": "report_cmd",
+        "corelens_args_file": "corelens_args_file",
+        "crash_cmds_file": "crash_cmds_file",
+        "lkce_outdir": "lkce_outdir",
+        "vmlinux_path": "vmlinux_path",
+        "vmcore": "vmcore",
+        "max_out_files": "max_out_files",
+    }
+
+    # contents of lkce.conf written by 'oled lkce configure --default'
+    DEFAULT_CONFIG = string.Template('''##
+# This is the configuration file for lkce
+# Use the 'oled lkce configure' command to change values
+##
+
+#report command to use for lkce
+report_cmd=$report_cmd
+
+#debuginfo vmlinux path. Need to install debuginfo kernel to get it
+vmlinux_path=$vmlinux_path
+
+#path to file containing crash commands to execute
+crash_cmds_file=$crash_cmds_file
+
+#path to file containing corelens command line arguments
+corelens_args_file=$corelens_args_file
+
+#lkce output directory path
+lkce_outdir=$lkce_outdir
+
+#enable vmcore generation post kdump_report
+vmcore=$vmcore
+
+#maximum number of outputfiles to retain. Older file gets deleted
+max_out_files=$max_out_files''')
+
+    # header of the generated lkce_kdump.sh; kdump_pre_sh_body follows it
+    KDUMP_SH_HEADER = string.Template('''#!/bin/sh
+# This is a kdump_pre script
+# This script is auto-generated. Changes made here will be overwritten.
+
+# Generate vmcore post LKCE kdump scripts execution
+LKCE_VMCORE="$vmcore"
+LKCE_KDUMP_SCRIPTS=$lkce_kdump_dir/*
+LKCE_OUTDIR="$lkce_outdir"
+LKCE_SYSROOT_DEV="$root_dev"
+LKCE_SYSROOT_UUID="$root_uuid"
+$dump_dev_env_set
+
+''')
+
+    # 'oled lkce configure' options and the config file keys they set
+    CONFIGURE_OPTIONS = {
+        "--corelens_args_file": "corelens_args_file",
+        "--crash_cmds_file": "crash_cmds_file",
+        "--vmlinux": "vmlinux_path",
+        "--vmlinux_path": "vmlinux_path",
+        "--report_cmd": "report_cmd",
+        "--lkce_outdir": "lkce_outdir",
+        "--vmcore": "vmcore",
+        "--max_out_files": "max_out_files",
+    }
+
+    # 'oled lkce report' options and the names they are stored under
+    REPORT_OPTIONS = {
+        "--vmcore": "vmcore",
+        "--vmlinux": "vmlinux",
+        "--report_cmd": "report_cmd",
+        "--crash_cmds": "crash_cmds",
+        "--corelens_args_file": "corelens_args_file",
+        "--outfile": "outfile",
+    }
+
     def __init__(self) -> None:
         """Constructor for Lkce class"""
         self.lkce_home = "/etc/oled/lkce"
         self.lkce_bindir = "/usr/lib/oled-tools"
         self.lkce_config_file = self.lkce_home + "/lkce.conf"
-        self.kdump_kernel_ver = platform.uname().release
+        self.kdump_kernel_ver = KERNEL_RELEASE
         self.vmcore = "yes"
         self.report_cmd = "corelens"
         self.lkce_outdir = "/var/oled/lkce"
         self.kdump_dirty = False
         self.is_configured = False
-        self.has_kdump_d = False
         self.kdump_d_dir = "/etc/kdump/pre.d"
         self.kdump_d_file = f"{self.kdump_d_dir}/10-lkce_kdump.sh"
 
         self.set_defaults()
 
         # set values from config file
-        if os.path.exists(self.lkce_config_file):
-            if self.read_config(self.lkce_config_file) == 0:
-                self.is_configured = True
+        if self.read_config(self.lkce_config_file) == 0:
+            self.is_configured = True
 
         # lkce as a kdump_pre hook to kexec-tools
         self.lkce_kdump_sh = self.lkce_home + "/lkce_kdump.sh"
@@ -194,20 +451,14 @@ class Lkce:
     # default values
     def set_defaults(self) -> None:
         """set default values"""
-        self.vmlinux_path = "/usr/lib/debug/lib/modules/" + \
-            self.kdump_kernel_ver + "/vmlinux"
-        self.crash_cmds_file = self.lkce_home + "/crash_cmds_file"
-        self.corelens_args_file = self.lkce_home + "/corelens_args_file"
+        self.vmlinux_path = DEFAULT_VMLINUX_PATH
+        self.crash_cmds_file = f"{self.lkce_home}/crash_cmds_file"
+        self.corelens_args_file = f"{self.lkce_home}/corelens_args_file"
         self.corelens_default_args = ["-a"]
         self.vmcore = "yes"
         self.report_cmd = "corelens"
         self.max_out_files = "50"
         self.lkce_outdir = "/var/oled/lkce"
-
-        try:
-            self.has_kdump_d = os.path.exists(self.kdump_d_dir)
-        except OSError:
-            self.has_kdump_d = False
     # def set_default
 
     def need_kdump_conf(self) -> bool:
@@ -216,7 +467,7 @@ class Lkce:
         """
         # Disabled for now, as scripts in pre.d will not short-circuit
         # execution, which is needed for inhibiting the extraction of vmcore.
-        # return self.has_kdump_d is not True
+        # return not os.path.exists(self.kdump_d_dir)
         return True
 
     def kdump_pre_d_link(self):
@@ -305,38 +556,18 @@ class Lkce:
 
         # config file
         filename = self.lkce_config_file
-        content = """##
-# This is the configuration file for lkce
-# Use the 'oled lkce configure' command to change values
-##
-
-#report command to use for lkce
-report_cmd=""" + self.report_cmd + """
-
-#debuginfo vmlinux path. Need to install debuginfo kernel to get it
-vmlinux_path=""" + self.vmlinux_path + """
-
-#path to file containing crash commands to execute
-crash_cmds_file=""" + self.crash_cmds_file + """
-
-#path to file containing corelens command line arguments
-corelens_args_file=""" + self.corelens_args_file + """
-
-#lkce output directory path
-lkce_outdir=""" + self.lkce_outdir + """
-
-#enable vmcore generation post kdump_report
-vmcore=""" + self.vmcore + """
-
-#maximum number of outputfiles to retain. Older file gets deleted
-max_out_files=""" + self.max_out_files
+        content = self.DEFAULT_CONFIG.substitute(
+            report_cmd=self.report_cmd, vmlinux_path=self.vmlinux_path,
+            crash_cmds_file=self.crash_cmds_file,
+            corelens_args_file=self.corelens_args_file,
+            lkce_outdir=self.lkce_outdir, vmcore=self.vmcore,
+            max_out_files=self.max_out_files)
 
         try:
-            file = open(filename, "w")
-            file.write(content)
-            file.close()
+            with open(filename, "w") as file:
+                file.write(content)
         except OSError:
-            print("Unable to operate on file: {filename}")
+            print(f"Unable to operate on file: {filename}")
             return 1
 
         self.is_configured = True
@@ -346,44 +577,26 @@ max_out_files=""" + self.max_out_files
 
     def read_config(self, filename: str) -> int:
         """Read config file and update the class variables"""
-        if not os.path.exists(filename):
-            return 1
-
         try:
-            file = open(filename, "r")
+            with open(filename, "r") as file:
+                for line in file:
+                    line = line.strip()
+                    # ignore empty lines and lines starting with '#'
+                    if not line or line[0] == "#":
+                        continue
+
+                    # kdump_report drops all whitespace from lkce.conf
+                    # lines; do the same so both agree on every value
+                    line = line.translate(DELETE_WHITESPACE)
+                    key, _, value = line.partition("=")
+                    attr = self.CONFIG_KEYS.get(key)
+                    if attr and value:
+                        setattr(self, attr, value)
+        except FileNotFoundError:
+            return 1
         except OSError:
-            print("Unable to open file: {filename}")
+            print(f"Unable to open file: {filename}")
             return 1
-
-        for line in file.readlines():
-            if re.search("^#", line):  # ignore lines starting with '#'
-                continue
-
-            # trim space/tab/newline from the line
-            line = re.sub(r"\s+", "", line)
-
-            entry = re.split("=", line)
-
-            if "report_cmd" in entry[0] and entry[1]:
-                self.report_cmd = entry[1]
-
-            elif "corelens_args_file" in entry[0] and entry[1]:
-                self.corelens_args_file = entry[1]
-
-            elif "crash_cmds_file" in entry[0] and entry[1]:
-                self.crash_cmds_file = entry[1]
-
-            elif "lkce_outdir" in entry[0] and entry[1]:
-                self.lkce_outdir = entry[1]
-
-            elif "vmlinux_path" in entry[0] and entry[1]:
-                self.vmlinux_path = entry[1]
-
-            elif "vmcore" in entry[0] and entry[1]:
-                self.vmcore = entry[1]
-
-            elif "max_out_files" in entry[0] and entry[1]:
-                self.max_out_files = entry[1]
         return 0
     # def read_config
 
@@ -393,20 +606,17 @@ max_out_files=""" + self.max_out_files
         lkce_kdump.sh is attached as kdump_pre hook in /etc/kdump.conf
         """
 
-        (dev, mnt) = get_dev_and_mount("/")
-        if not dev or not mnt:
+        (root_dev, mnt) = get_dev_and_mount("/")
+        if not root_dev or not mnt:
             print(
                 f"error: Unable to find the device for /")
             return 1
 
-        uuid = get_dev_uuid(dev)
-        if not uuid:
-            print(f"error: Unable to find the UUID for {dev}")
+        root_uuid = get_dev_uuid(root_dev)
+        if not root_uuid:
+            print(f"error: Unable to find the UUID for {root_dev}")
             return 1
 
-        dumpdir_env_set = f'''LKCE_SYSROOT_DEV="{dev}"
-LKCE_SYSROOT_UUID="{uuid}"\n'''
-
         try:
             os.makedirs(self.lkce_kdump_dir, exist_ok=True)
         except OSError as e:
@@ -425,45 +635,41 @@ LKCE_SYSROOT_UUID="{uuid}"\n'''
                 f"error: Unable to find the mountpoint for {self.lkce_outdir}")
             return 1
 
-        uuid = get_dev_uuid(dev)
-        if not uuid:
-            print(f"error: Unable to find the UUID for {dev}")
-            return 1
-
+        dump_dev_env_set = ""
         if mnt != "/":
-            dumpdir_env_set += f'''LKCE_DUMP_DEV="{dev}"
+            # the UUID is only needed when the output directory lives on a
+            # filesystem other than /
+            uuid = root_uuid if dev == root_dev else get_dev_uuid(dev)
+            if not uuid:
+                print(f"error: Unable to find the UUID for {dev}")
+                return 1
+
+            dump_dev_env_set = f'''LKCE_DUMP_DEV="{dev}"
 LKCE_DUMP_DEV_UUID="{uuid}"
 LKCE_DUMP_DEV_MNT="{mnt}"'''
 
         # create lkce_kdump.sh script
-        content = '''#!/bin/sh
-# This is a kdump_pre script
-# This script is auto-generated. Changes made here will be overwritten.
-
-# Generate vmcore post LKCE kdump scripts execution
-LKCE_VMCORE="''' + self.vmcore + '''"
-LKCE_KDUMP_SCRIPTS=''' + self.lkce_kdump_dir + '''/*
-LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
+        content = self.KDUMP_SH_HEADER.substitute(
+            vmcore=self.vmcore, lkce_kdump_dir=self.lkce_kdump_dir,
+            lkce_outdir=self.lkce_outdir, root_dev=root_dev,
+            root_uuid=root_uuid, dump_dev_env_set=dump_dev_env_set)
 
         filename = self.lkce_kdump_sh
         try:
-            file = open(filename, "w")
-            file.write(content)
-            body = open(f"{self.lkce_home}/kdump_pre_sh_body")
-            file.write(body.read())
-            body.close()
-            file.close()
+            with open(f"{self.lkce_home}/kdump_pre_sh_body", "rb") as body:
+                script = content.encode() + body.read()
+            # create the script executable right away; fchmod() also covers
+            # an existing file and any bits masked out by the umask
+            mode = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | \
+                stat.S_IROTH | stat.S_IXOTH
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         mode)
+            with os.fdopen(fd, "wb") as file:
+                os.fchmod(fd, mode)
+                file.write(script)
         except OSError as e:
             print(f"Unable to operate on file: {filename}: {e}")
             return 1
-
-        mode = os.stat(filename).st_mode
-        try:
-            os.chmod(filename,
-                     mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-        except OSError as e:
-            print(f"error: Unable to make {filename} executable: {e}")
-            return 1
         return 0
     # def create_lkce_kdump
 
@@ -537,18 +743,24 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
         if arg == "--remove":
             try:
                 with open(self.kdump_conf, "r+") as conf_fd:
-                    conf_lines = conf_fd.read().splitlines()
-
-                    if kdump_pre_line not in conf_lines:
+                    found = False
+                    new_lines = []
+                    for line in conf_fd:
+                        if line.rstrip("\n") == kdump_pre_line:
+                            found = True
+                        else:
+                            new_lines.append(line)
+
+                    if not found:
                         print("LKCE is not currently enabled",
                               f"in {self.kdump_conf}")
                         return 2
-                    conf_lines.remove(kdump_pre_line)
+                    content = "".join(new_lines)
+                    if content and not content.endswith("\n"):
+                        content += "\n"
                     conf_fd.seek(0)
-                    conf_fd.write("\n".join(conf_lines))
-                    conf_fd.write("\n")
+                    conf_fd.write(content)
                     conf_fd.truncate()
-                    conf_fd.close()
             except OSError as e:
                 print(f"error: Unable to update {self.kdump_conf}: {e}")
                 return 1
@@ -576,9 +788,13 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
 
         try:
             # add the LKCE kdump_pre line to /etc/kdump.conf
-            with open(self.kdump_conf, "a") as conf_fd:
-                conf_fd.write(f"{kdump_pre_line}\n")
-                conf_fd.close()
+            with open(self.kdump_conf, "ab+") as conf_fd:
+                # don't glue our line onto a last line lacking its newline
+                if conf_fd.tell():
+                    conf_fd.seek(-1, os.SEEK_END)
+                    if conf_fd.read(1) != b"\n":
+                        conf_fd.write(b"\n")
+                conf_fd.write(f"{kdump_pre_line}\n".encode())
         except OSError as e:
             print(f"Error updating /etc/kdump.conf: {e}")
             return 1
@@ -596,32 +812,30 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
 
         d_subargs = {}
         for subarg in subargs:
-            subarg.strip()
-            entry = subarg.split("=", 1)
+            subarg = subarg.strip()
+            option, sep, value = subarg.partition("=")
 
-            if len(entry) < 2:
+            if not sep:
                 print(f"error: unknown report option: {subarg}")
                 continue
 
-            if entry[0] not in ("--vmcore", "--vmlinux", "--report_cmd",
-                                "--crash_cmds", "--corelens_args_file",
-                                "--outfile"):
-
-                print(f"error: unknown report option: {entry[0]}")
+            name = self.REPORT_OPTIONS.get(option.strip())
+            if name is None:
+                print(f"error: unknown report option: {option}")
                 break
 
-            d_subargs[entry[0].strip()] = entry[1].strip()
+            d_subargs[name] = value.strip()
         # for
 
-        vmcore = d_subargs.get("--vmcore", None)
-        outfile = d_subargs.get("--outfile", None)
+        vmcore = d_subargs.get("vmcore", None)
+        outfile = d_subargs.get("outfile", None)
 
         if vmcore is None:
             print("error: vmcore not specified")
             return
 
         if self.report_cmd == "crash":
-            vmlinux = d_subargs.get("--vmlinux", None)
+            vmlinux = d_subargs.get("vmlinux", None)
             if vmlinux is None:
                 vmlinux = self.vmlinux_path
 
@@ -629,7 +843,7 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
                 print(f"error: vmlinux '{vmlinux}' not found")
                 return
 
-            crash_cmds = d_subargs.get("--crash_cmds", None)
+            crash_cmds = d_subargs.get("crash_cmds", None)
 
             if crash_cmds is None:
                 # use configured crash commands file
@@ -647,49 +861,25 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
                 cmd_input = "\n".join(crash_cmds.split(",")).encode("utf-8")
 
             print("lkce: executing '{}'".format(" ".join(cmd)))
-
-            if outfile:
-                with open(outfile, "w") as output_fd:
-                    subprocess.run(
-                        cmd, input=cmd_input, stdout=output_fd, check=True,
-                        shell=False)  # nosec
-            else:
-                subprocess.run(
-                    cmd, input=cmd_input, stdout=sys.stdout, check=True,
-                    shell=False)  # nosec
+            run_report_cmd(cmd, outfile, cmd_input)
         elif self.report_cmd == "corelens":
-            corelens_args_file = d_subargs.get("--corelens_args_file", None)
+            corelens_args_file = d_subargs.get("corelens_args_file", None)
 
             cmd: List[str] = ["corelens", vmcore]
             if corelens_args_file is None:
                 # use configured corelens arguments file
-                if not os.path.isfile(self.corelens_args_file):
-                    print(f"corelens_args_file '{self.corelens_args_file}' "
-                          "not found")
-                else:
-                    corelens_args_file = self.corelens_args_file
+                corelens_args_file = self.corelens_args_file
 
-            if corelens_args_file is None:
+            # read_args_from_file() reports a missing or unreadable file;
+            # fall back to the default arguments in that case
+            corelens_args = read_args_from_file(corelens_args_file)
+            if corelens_args is None:
                 cmd.extend(self.corelens_default_args)
             else:
-                # use specified corelens arguments file
-                corelens_args = read_args_from_file(corelens_args_file)
-                if corelens_args is None:
-                    cmd.extend(self.corelens_default_args)
-                else:
-                    cmd.extend(corelens_args)
+                cmd.extend(corelens_args)
 
             print("lkce: executing '{}'".format(" ".join(cmd)))
-
-            if outfile:
-                with open(outfile, "w") as output_fd:
-                    subprocess.run(
-                        cmd, stdout=output_fd, check=True,
-                        shell=False)  # nosec
-            else:
-                subprocess.run(
-                    cmd, stdout=sys.stdout, check=True,
-                    shell=False)  # nosec
+            run_report_cmd(cmd, outfile)
         else:
             print(f"lkce: error: Unknown report command: {self.report_cmd}")
     # def report
@@ -707,42 +897,27 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
         values_to_update = {}
         filename = self.lkce_config_file
         for subarg in subargs:
-            subarg.strip()
+            subarg = subarg.strip()
             if subarg == "--default":
                 if self.configure_default():
                     print("error: LKCE default configuration failed.")
                     return
             elif subarg == "--show":
-                if not os.path.exists(filename):
-                    print(f"error: LKCE config file {filename} not found.\n"
-                          "Please run 'oled lkce configure --default' first.")
+                if self.show_config():
                     return
-
-                print("%18s : %s" % ("report_cmd", self.report_cmd))
-                print("%18s : %s" %
-                      ("corelens_args_file", self.corelens_args_file))
-                print("%18s : %s" % ("vmcore", self.vmcore))
-                print("%18s : %s" % ("vmlinux path", self.vmlinux_path))
-                print("%18s : %s" % ("crash_cmds_file", self.crash_cmds_file))
-                print("%18s : %s" % ("lkce_outdir", self.lkce_outdir))
-                print("%18s : %s" % ("lkce_in_kexec", self.kexec_enabled()))
-                print("%18s : %s" % ("max_out_files", self.max_out_files))
             else:
-                entry = subarg.split("=", 1)
+                option, sep, value = subarg.partition("=")
 
-                if len(entry) < 2:
+                if not sep:
                     print(f"error: no value given for option {subarg}")
                     return
 
-                if entry[0] not in ("--corelens_args_file",
-                                    "--crash_cmds_file",
-                                    "--vmlinux", "--report_cmd",
-                                    "--lkce_outdir", "--vmcore",
-                                    "--max_out_files"):
+                key = self.CONFIGURE_OPTIONS.get(option.strip())
+                if key is None:
                     print(f"error: unknown configure option: {subarg}")
                     return
 
-                values_to_update[entry[0].strip("-")] = entry[1].strip()
+                values_to_update[key] = value.strip()
 
         if not self.is_configured:
             print(f"error: LKCE has not been configured.\n"
@@ -762,6 +937,11 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
         if lkce_outdir and self.config_lkce_outdir(lkce_outdir):
             return
 
+        max_out_files = values_to_update.get("max_out_files", None)
+        if max_out_files is not None and \
+                self.config_max_out_files(max_out_files):
+            return
+
         if values_to_update:
             update_key_values_file(filename, values_to_update, sep="=")
 
@@ -776,6 +956,32 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
                     self.backup_kdump_conf()
     # def configure
 
+    def get_config(self) -> Dict[str, object]:
+        """Return the current configuration values, keyed by display name"""
+        return {
+            "report_cmd": self.report_cmd,
+            "corelens_args_file": self.corelens_args_file,
+            "vmcore": self.vmcore,
+            "vmlinux path": self.vmlinux_path,
+            "crash_cmds_file": self.crash_cmds_file,
+            "lkce_outdir": self.lkce_outdir,
+            "lkce_in_kexec": self.kexec_enabled(),
+            "max_out_files": self.max_out_files,
+        }
+    # def get_config
+
+    def show_config(self) -> int:
+        """Print the current configuration values"""
+        if not self.is_configured:
+            print(f"error: LKCE config file {self.lkce_config_file} not "
+                  "found.\nPlease run 'oled lkce configure --default' first.")
+            return 1
+
+        for name, value in self.get_config().items():
+            print("%18s : %s" % (name, value))
+        return 0
+    # def show_config
+
     def config_vmcore(self, value: str) -> int:
         """Configure vmcore value in lkce_config_file.
 
@@ -829,6 +1035,19 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
         return 0
     # def config_lkce_outdir
 
+    def config_max_out_files(self, value: str) -> int:
+        """Configure max_out_files value in lkce_config_file.
+
+        Called from configure()
+        """
+        if parse_max_out_files(value) is None:
+            print(f"error: Invalid max_out_files value: {value}")
+            return 1
+
+        self.max_out_files = value
+        return 0
+    # def config_max_out_files
+
     def enable_lkce_kexec(self) -> int:
         """Enable LKCE vmcore reports in kexec mode"""
 
@@ -886,62 +1105,97 @@ LKCE_OUTDIR="''' + self.lkce_outdir + '"\n' + dumpdir_env_set + "\n\n"
 
     def status(self) -> None:
         """Show current configuration values"""
-        self.configure(subargs=["--show"])
+        self.show_config()
 
         if self.report_cmd == "crash":
             pkg = "crash"
         else:
             pkg = "drgn-tools"
 
-        r = subprocess.run(("rpm", "-q", pkg), shell=False,  # nosec
-                           check=False)
-        if r.returncode != 0:
+        if not pkg_installed(pkg):
             print(f"NOTE: The {pkg} package is not installed.")
     # def status
 
     def clean(self, subarg: List[str]) -> None:
         """Clean up old crash and corelens reports to save space"""
         report_files = []
-        for p in ("crash*.out", "corelens*.out"):
-            report_files.extend(glob.glob(f"{self.lkce_outdir}/{p}"))
-
-        if "--all" in subarg:
-            val = input("lkce will delete all the"
-                        f"{self.lkce_outdir}/crash*.out and "
-                        f"{self.lkce_outdir}/corelens*.out files.\n"
-                        "Do you want to proceed? (yes/no) [no]: ")
-            if "yes" not in val:
-                return
+        try:
+            with os.scandir(self.lkce_outdir) as it:
+                for entry in it:
+                    if is_report_name(entry.name) and entry.is_file():
+                        report_files.append(entry)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"error: Unable to scan {self.lkce_outdir}: {e}")
+            return
+
+        clean_all = "--all" in subarg
+        # number of newest reports to keep
+        max_out_files = (0 if clean_all
+                         else parse_max_out_files(self.max_out_files))
+        if max_out_files is None:
+            print(f"error: Invalid max_out_files value: {self.max_out_files}")
+            return
+
+        if len(report_files) <= max_out_files:
+            print(f"No reports to clean in {self.lkce_outdir}")
+            return
+
+        if clean_all:
+            prompt = ("lkce will delete all the "
+                      f"{self.lkce_outdir}/crash*.out and "
+                      f"{self.lkce_outdir}/corelens*.out files.\n")
         else:
-            val = input("lkce will delete all but the last "
-                        f"{self.max_out_files} {self.lkce_outdir}/crash*.out "
-                        f"and {self.lkce_outdir}/corelens*.out files.\n"
-                        "Do you want to proceed? (yes/no) [no]: ")
-            if "yes" not in val:
+            prompt = ("lkce will delete all but the last "
+                      f"{self.max_out_files} {self.lkce_outdir}/crash*.out "
+                      f"and {self.lkce_outdir}/corelens*.out files.\n")
+
+        # --yes skips the confirmation, e.g. when run from cron
+        if "--yes" not in subarg:
+            val = input(prompt + "Do you want to proceed? (yes/no) [no]: ")
+            if val.strip().lower() != "yes":
                 return
 
+        if not clean_all:
             # select all crash/corelens files but the N newest ones
-            # where N == self.max_out_files
-            report_files.sort(
-                key=lambda x: os.path.getctime(x), reverse=True)
-            report_files = report_files[int(self.max_out_files):]
+            # where N == max_out_files
+            keep = set(heapq.nlargest(max_out_files, report_files,
+                                      key=lambda e: e.stat().st_ctime_ns))
+            report_files = [e for e in report_files if e not in keep]
 
-        for f in report_files:
-            try:
-                os.remove(f)
-            except OSError as e:
-                print(f"error: Unable to remove {f}: {e}")
+        try:
+            dir_fd = os.open(self.lkce_outdir, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            print(f"error: Unable to open {self.lkce_outdir}: {e}")
+            return
+
+        try:
+            for entry in report_files:
+                try:
+                    os.unlink(entry.name, dir_fd=dir_fd)
+                except OSError as e:
+                    print(f"error: Unable to remove {entry.path}: {e}")
+        finally:
+            os.close(dir_fd)
     # def clean
 
     def listfiles(self) -> None:
         """List corelens reports already generated"""
         dirname = self.lkce_outdir
-        os.makedirs(dirname, exist_ok=True)
+        lines = [f"The following are the reports found in {dirname}:"]
+        try:
+            with os.scandir(dirname) as it:
+                lines.extend(entry.path for entry in it
+                             if is_report_name(entry.name) and entry.is_file())
+        except FileNotFoundError:
+            # nothing has been generated yet
+            pass
+        except OSError as e:
+            print(f"error: Unable to scan {dirname}: {e}")
+            return
 
-        print(f"The following are the reports found in {dirname}:")
-        for filename in os.listdir(dirname):
-            if re.search("(crash|corelens).*out", filename):
-                print(f"{dirname}/{filename}")
+        print("\n".join(lines))
     # def listfiles
 
 # class LKCE
@@ -953,19 +1207,19 @@ def restart_kdump_service() -> int:
 
     print("Restarting kdump service...")
     try:
-        r = subprocess.run(cmd, shell=False, check=True)  # nosec
-        if r.returncode == 0:
-            print("done!")
-        return r.returncode
-    except subprocess.CalledProcessError:
-        pass
-    return 1
+        r = subprocess.run(cmd, shell=False, check=False)  # nosec
+    except OSError as e:
+        print(f"error: Unable to run systemctl: {e}")
+        return 1
+
+    if r.returncode != 0:
+        return 1
+    print("done!")
+    return 0
 # def restart_kdump_service
 
 
-def usage() -> int:
-    """Print usage"""
-    usage_ = """Usage: """ + os.path.basename(sys.argv[0]) + """ <options>
+USAGE = f"""Usage: {os.path.basename(sys.argv[0])} <options>
 options:
     report <report-options> -- Generate a report from vmcore
     report-options:
@@ -990,63 +1244,80 @@ options:
     disable_kexec   -- disable lkce in kdump kernel
     status          -- status of lkce
 
-    clean [--all]   -- clear crash/corelens report files
+    clean [--all] [--yes] -- clear crash/corelens report files
+                             (--yes: don't ask for confirmation)
     list            -- list crash/corelens report files
 """
-    print(usage_)
+
+
+def usage() -> int:
+    """Print usage"""
+    print(USAGE)
     sys.exit(0)
 # def usage
 
 
-def main() -> int:
-    """Main routine"""
-    lkce = Lkce()
+def cmd_report(lkce: Lkce, args: List[str]) -> None:
+    """Handle 'lkce report'"""
+    if not lkce.is_configured:
+        print("warning: LKCE has not been configured.\n"
+              "Please run 'oled lkce configure --default'")
+    lkce.report(args)
+# def cmd_report
 
-    if len(sys.argv) < 2:
-        usage()
 
-    arg = sys.argv[1]
-    if arg == "report":
-        if not lkce.is_configured:
-            print("warning: LKCE has not been configured.\n"
-                  "Please run 'oled lkce configure --default'")
-        lkce.report(sys.argv[2:])
-
-    elif arg == "configure":
-        lkce.configure(sys.argv[2:])
-
-    elif arg == "enable_kexec":
-        if lkce.is_configured:
-            if lkce.enable_lkce_kexec() == 1:
-                print("error: Unable to enable LKCE in kexec mode")
-        else:
-            print("error: LKCE has not been configured.\n"
-                  "Please run 'oled lkce configure --default' first.")
+def cmd_enable_kexec(lkce: Lkce, _args: List[str]) -> None:
+    """Handle 'lkce enable_kexec'"""
+    if lkce.is_configured:
+        if lkce.enable_lkce_kexec() == 1:
+            print("error: Unable to enable LKCE in kexec mode")
+    else:
+        print("error: LKCE has not been configured.\n"
+              "Please run 'oled lkce configure --default' first.")
+# def cmd_enable_kexec
 
-    elif arg == "disable_kexec":
-        if lkce.is_configured:
-            if lkce.disable_lkce_kexec() == 1:
-                print("error: Unable to disable LKCE in kexec mode")
-        else:
-            print("error: LKCE has not been configured.\n"
-                  "Please run 'oled lkce configure --default' first.")
 
-    elif arg == "status":
-        lkce.status()
+def cmd_disable_kexec(lkce: Lkce, _args: List[str]) -> None:
+    """Handle 'lkce disable_kexec'"""
+    if lkce.is_configured:
+        if lkce.disable_lkce_kexec() == 1:
+            print("error: Unable to disable LKCE in kexec mode")
+    else:
+        print("error: LKCE has not been configured.\n"
+              "Please run 'oled lkce configure --default' first.")
+# def cmd_disable_kexec
+
 
-    elif arg == "clean":
-        lkce.clean(sys.argv[2:])
+# subcommand -> handler(lkce, args)
+COMMANDS: Dict[str, Callable[[Lkce, List[str]], None]] = {
+    "report": cmd_report,
+    "configure": lambda lkce, args: lkce.configure(args),
+    "enable_kexec": cmd_enable_kexec,
+    "disable_kexec": cmd_disable_kexec,
+    "status": lambda lkce, _args: lkce.status(),
+    "clean": lambda lkce, args: lkce.clean(args),
+    "list": lambda lkce, _args: lkce.listfiles(),
+}
 
-    elif arg == "list":
-        lkce.listfiles()
+HELP_ARGS = frozenset(("help", "-help", "--help", "-h"))
 
-    elif arg in ("help", "-help", "--help", "-h"):
+
+def main() -> int:
+    """Main routine"""
+    if len(sys.argv) < 2:
         usage()
 
-    else:
+    arg = sys.argv[1]
+    if arg in HELP_ARGS:
+        usage()
+
+    handler = COMMANDS.get(arg)
+    if handler is None:
         print(f"Invalid option: {arg}")
         print("Try 'oled lkce help' for more information")
+        return 0
 
+    handler(Lkce(), sys.argv[2:])
     return 0
 # def main
 
@@ -1057,26 +1328,36 @@ if __name__ == '__main__':
         sys.exit(1)
 
     LOCK_DIR = "/var/run/oled-tools"
+    LOCK_FILE = LOCK_DIR + "/lkce.lock"
     try:
-        if not os.path.isdir(LOCK_DIR):
-            os.makedirs(LOCK_DIR)
-        LOCK_FILE = LOCK_DIR + "/lkce.lock"
+        os.makedirs(LOCK_DIR, exist_ok=True)
 
-        FH = open(LOCK_FILE, "w")
+        # don't truncate here; the file may hold the pid of a running lkce.
+        # Don't follow a planted symlink, and don't leak the fd to children.
+        FH = os.fdopen(os.open(LOCK_FILE,
+                               os.O_WRONLY | os.O_CREAT | os.O_APPEND |
+                               os.O_CLOEXEC | os.O_NOFOLLOW, 0o600), "a")
     except OSError:
         print(f"Unable to open file: {LOCK_FILE}")
         sys.exit()
 
     # try lock
     try:
-        fcntl.flock(FH, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.lockf(FH, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except OSError:  # no lock
         print("error: another instance of lkce is running.")
         sys.exit()
 
+    # record the lock holder
+    FH.truncate(0)
+    FH.write(f"{os.getpid()}\n")
+    FH.flush()
+
+    # The lock file is never removed: deleting it would let one instance
+    # lock the unlinked inode while another locks a freshly created file.
+    # The lock itself is dropped by the kernel however we exit.
+
     try:
         main()
-        FH.close()
-        os.remove(LOCK_FILE)
     except KeyboardInterrupt:
         print("\nInterrupted by user ctrl+c")